@@ -1,4 +1,5 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import numpy as np
 from datetime import datetime, timedelta
@@ -6,40 +7,82 @@ import joblib
 import os
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
+from server.ml.iop_model import file_lock, get_model, predict_iop_24h, save_atomically
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider that serializes with orjson"""
+    # Sort keys like Flask's default provider so output is the same with or without orjson
+    sort_keys = True
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Use orjson for request/response JSON when it is installed
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+# Random generator for prediction noise, kept separate from the global np.random state
+rng = np.random.default_rng()
+
+# Circadian IOP offset for each hour of the day (peak around 8am)
+CIRCADIAN_EFFECT = 4 * np.sin((np.arange(24) - 8) * np.pi / 12)
+
 
 # Initialize or load model
 def initialize_model():
     model_path = 'model.pkl'
     scaler_path = 'scaler.pkl'
+    lock_path = 'model.lock'
+
+    # Hold an exclusive lock so that when several workers start at once only
+    # the first one trains; the others wait and then load what it saved
+    with file_lock(lock_path):
+        if os.path.exists(model_path) and os.path.exists(scaler_path):
+            # Load existing model
+            model = joblib.load(model_path)
+            scaler = joblib.load(scaler_path)
+            print("Loaded existing model")
+        else:
+            # Create a simple model for demonstration
+            print("Creating new model for demonstration...")
+            model = RandomForestRegressor(n_estimators=30, max_depth=8, random_state=42, n_jobs=-1)
+            scaler = StandardScaler()
 
-    if os.path.exists(model_path) and os.path.exists(scaler_path):
-        # Load existing model
-        model = joblib.load(model_path)
-        scaler = joblib.load(scaler_path)
-        print("Loaded existing model")
-    else:
-        # Create a simple model for demonstration
-        print("Creating new model for demonstration...")
-        model = RandomForestRegressor(n_estimators=50, random_state=42)
-        scaler = StandardScaler()
+            # Create simple training data
+            np.random.seed(42)
+            X_train = np.random.rand(100, 5).astype(np.float32)  # 100 samples, 5 features
+            y_train = 15 + np.random.rand(100) * 10  # IOP values between 15-25 mmHg
 
-        # Create simple training data
-        np.random.seed(42)
-        X_train = np.random.rand(100, 5)  # 100 samples, 5 features
-        y_train = 15 + np.random.rand(100) * 10  # IOP values between 15-25 mmHg
+            # Train model
+            X_scaled = scaler.fit_transform(X_train)
+            model.fit(X_scaled, y_train)
 
-        # Train model
-        X_scaled = scaler.fit_transform(X_train)
-        model.fit(X_scaled, y_train)
+            # Save model, writing to temporary files first so a crash never leaves a partial pickle
+            save_atomically(model, model_path)
+            save_atomically(scaler, scaler_path)
+            print("Created and saved new model")
 
-        # Save model
-        joblib.dump(model, model_path)
-        joblib.dump(scaler, scaler_path)
-        print("Created and saved new model")
+    # Parallel trees only help fitting; for the single-row predictions made per
+    # request a joblib thread pool costs more than it saves
+    model.n_jobs = 1
 
     return model, scaler
 
@@ -47,6 +90,15 @@ def initialize_model():
 # Initialize the model
 model, scaler = initialize_model()
 
+# Load (or train) the 24-hour model up front so the first
+# /api/predict-iop-v2 request does not pay for it
+get_model()
+
+# Capture the scaler parameters so requests can standardize inputs without
+# going through StandardScaler.transform's validation for a single row
+scaler_mean = scaler.mean_.astype(np.float64)
+scaler_inv_scale = (1.0 / scaler.scale_).astype(np.float64)
+
 
 @app.route('/')
 def home():
@@ -65,7 +117,7 @@ def predict_iop():
 
     try:
         patient_data = request.json
-        print("Received data:", patient_data)  # Debug print
+        app.logger.debug("Received data: %s", patient_data)
 
         # Set defaults for missing values
         defaults = {
@@ -81,138 +133,144 @@ def predict_iop():
                 patient_data[key] = value
 
         # Prepare input for the model
-        model_input = np.array([[
+        model_input = np.array([
             patient_data['age'],
             patient_data['sleep_quality'],
             patient_data['stress_level'],
             patient_data['physical_activity'],
             patient_data['last_drop_hours_ago'],
-        ]])
+        ], dtype=np.float64)
 
         # Scale and predict
-        model_input_scaled = scaler.transform(model_input)
+        # The forest evaluates its splits in float32, so hand it float32 directly
+        model_input_scaled = ((model_input - scaler_mean) * scaler_inv_scale).astype(np.float32).reshape(1, 5)
         base_prediction = model.predict(model_input_scaled)[0]
 
         # Generate IOP predictions with circadian rhythm
-        predictions = generate_iop_predictions(base_prediction, patient_data)
+        predictions, iop_values = generate_iop_predictions(base_prediction, patient_data)
 
         # Calculate optimal drop time
-        optimal_time = calculate_optimal_drop_time(predictions)
+        optimal_time = calculate_optimal_drop_time(predictions, iop_values)
 
         response = {
             'predictions': predictions,
             'optimal_drop_time': optimal_time,
-            'circadian_analysis': analyze_circadian_pattern(predictions),
-            'risk_assessment': assess_overall_risk(predictions),
+            'circadian_analysis': analyze_circadian_pattern(predictions, iop_values),
+            'risk_assessment': assess_overall_risk(predictions, iop_values),
             'model_type': 'demo_model'
         }
 
         return jsonify(response)
 
     except Exception as e:
-        print("Error:", str(e))  # Debug print
+        app.logger.error("Error: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
 def generate_iop_predictions(base_prediction, patient_data):
-    """Generate IOP predictions with circadian rhythm patterns"""
-    predictions = []
+    """Generate IOP predictions with circadian rhythm patterns, plus their IOP values as an array"""
     current_time = datetime.now()
+    prediction_times = [current_time + timedelta(hours=hour_offset) for hour_offset in range(24)]
+    hours = np.array([prediction_time.hour for prediction_time in prediction_times])
 
-    for hour_offset in range(24):
-        prediction_time = current_time + timedelta(hours=hour_offset)
+    # Create circadian rhythm pattern (higher in morning)
+    circadian_effect = CIRCADIAN_EFFECT[hours]
 
-        # Create circadian rhythm pattern (higher in morning)
-        hour = prediction_time.hour
-        circadian_effect = 4 * np.sin((hour - 8) * np.pi / 12)  # Peak around 8am
+    # Adjust based on patient factors
+    sleep_effect = (10 - patient_data['sleep_quality']) * 0.3
+    stress_effect = patient_data['stress_level'] * 0.4
+    activity_effect = -patient_data['physical_activity'] * 0.2
 
-        # Adjust based on patient factors
-        sleep_effect = (10 - patient_data['sleep_quality']) * 0.3
-        stress_effect = patient_data['stress_level'] * 0.4
-        activity_effect = -patient_data['physical_activity'] * 0.2
+    # Apply medication effect if recently taken
+    medication_effect = 0
+    if patient_data['last_drop_hours_ago'] < 12:
+        medication_effect = -3 * (12 - patient_data['last_drop_hours_ago']) / 12
 
-        # Apply medication effect if recently taken
-        medication_effect = 0
-        if patient_data['last_drop_hours_ago'] < 12:
-            medication_effect = -3 * (12 - patient_data['last_drop_hours_ago']) / 12
+    predicted_iops = base_prediction + circadian_effect + sleep_effect + stress_effect + activity_effect + medication_effect
 
-        predicted_iop = base_prediction + circadian_effect + sleep_effect + stress_effect + activity_effect + medication_effect
+    # Add some randomness for realism
+    predicted_iops += rng.normal(0, 0.5, 24)
 
-        # Add some randomness for realism
-        predicted_iop += np.random.normal(0, 0.5)
+    # Ensure IOP stays in realistic range (10-30 mmHg)
+    predicted_iops = np.clip(np.round(predicted_iops, 1), 10, 30)
 
-        # Ensure IOP stays in realistic range (10-30 mmHg)
-        predicted_iop = max(10, min(30, round(predicted_iop, 1)))
+    time_strs = [prediction_time.strftime('%Y-%m-%d %H:%M') for prediction_time in prediction_times]
 
-        predictions.append({
-            'time': prediction_time.strftime('%Y-%m-%d %H:%M'),
-            'hour': prediction_time.hour,
+    predictions = [
+        {
+            'time': time_str,
+            'hour': hour,
             'predicted_iop': predicted_iop,
-            'risk_level': calculate_risk_level(predicted_iop),
-            'recommended_action': generate_recommendation(predicted_iop, prediction_time.hour)
-        })
+            'risk_level': risk_level,
+            'recommended_action': recommended_action
+        }
+        for time_str, hour, predicted_iop, risk_level, recommended_action in zip(
+            time_strs, hours.tolist(), predicted_iops.tolist(),
+            calculate_risk_levels(predicted_iops), generate_recommendations(predicted_iops, hours))
+    ]
 
-    return predictions
+    return predictions, predicted_iops
 
 
-def calculate_risk_level(iop_value):
-    if iop_value < 18:
-        return "low"
-    elif iop_value < 22:
-        return "moderate"
-    elif iop_value < 26:
-        return "high"
-    else:
-        return "critical"
+RISK_LEVELS = np.array(["low", "moderate", "high", "critical"])
+RISK_THRESHOLDS = [18, 22, 26]
 
 
-def generate_recommendation(iop_value, hour):
-    if iop_value > 25:
-        return "Consider emergency consultation - very high pressure detected"
-    elif iop_value > 21:
-        return "Administer drops and avoid stressful activities"
-    elif iop_value > 18:
-        if hour >= 20 or hour <= 6:
-            return "Monitor through night - consider sleep position adjustment"
-        else:
-            return "Normal pressure - maintain current regimen"
-    else:
-        return "Pressure well-controlled - continue current treatment"
+def calculate_risk_levels(iop_values):
+    """Classify each IOP value as low (<18), moderate (<22), high (<26) or critical"""
+    return RISK_LEVELS[np.searchsorted(RISK_THRESHOLDS, iop_values, side='right')].tolist()
+
+
+def generate_recommendations(iop_values, hours):
+    """Pick the recommended action for each IOP value and hour of day"""
+    night = (hours >= 20) | (hours <= 6)
+    return np.select(
+        [iop_values > 25, iop_values > 21, (iop_values > 18) & night, iop_values > 18],
+        [
+            "Consider emergency consultation - very high pressure detected",
+            "Administer drops and avoid stressful activities",
+            "Monitor through night - consider sleep position adjustment",
+            "Normal pressure - maintain current regimen",
+        ],
+        default="Pressure well-controlled - continue current treatment"
+    ).tolist()
 
 
-def calculate_optimal_drop_time(predictions):
+def calculate_optimal_drop_time(predictions, iop_values):
     """Calculate the best time to administer drops based on prediction pattern"""
     # Find when IOP starts rising significantly
     threshold = 21  # mmHg
-    for i in range(1, len(predictions)):
-        if (predictions[i]['predicted_iop'] > threshold and
-                predictions[i]['predicted_iop'] > predictions[i - 1]['predicted_iop']):
-            return predictions[i]['time']
+    rising = np.flatnonzero((iop_values[1:] > threshold) & (iop_values[1:] > iop_values[:-1]))
+    if len(rising):
+        return predictions[rising[0] + 1]['time']
 
     # Default to morning if no critical rise detected
     return "08:00"
 
 
-def analyze_circadian_pattern(predictions):
+def analyze_circadian_pattern(predictions, iop_values):
     """Analyze the circadian rhythm pattern from predictions"""
-    iop_values = [p['predicted_iop'] for p in predictions]
+    peak_idx = int(iop_values.argmax())
+    trough_idx = int(iop_values.argmin())
+    peak_iop = float(iop_values[peak_idx])
+    trough_iop = float(iop_values[trough_idx])
 
     analysis = {
-        'peak_iop': max(iop_values),
-        'trough_iop': min(iop_values),
-        'avg_iop': sum(iop_values) / len(iop_values),
-        'amplitude': max(iop_values) - min(iop_values),
-        'peak_time': predictions[iop_values.index(max(iop_values))]['time'],
-        'trough_time': predictions[iop_values.index(min(iop_values))]['time']
+        'peak_iop': peak_iop,
+        'trough_iop': trough_iop,
+        'avg_iop': float(iop_values.mean()),
+        'amplitude': peak_iop - trough_iop,
+        'peak_time': predictions[peak_idx]['time'],
+        'trough_time': predictions[trough_idx]['time']
     }
 
     return analysis
 
 
-def assess_overall_risk(predictions):
+def assess_overall_risk(predictions, iop_values):
     """Provide overall risk assessment based on predictions"""
-    high_iop_hours = sum(1 for p in predictions if p['predicted_iop'] > 21)
-    critical_iop_hours = sum(1 for p in predictions if p['predicted_iop'] > 25)
+    high_iop_hours = int((iop_values > 21).sum())
+    critical_iop_hours = int((iop_values > 25).sum())
 
     risk_percentage = (high_iop_hours / len(predictions)) * 100
 
@@ -242,6 +300,17 @@ def assess_overall_risk(predictions):
         }
 
 
+@app.route('/api/predict-iop-v2', methods=['POST'])
+def predict_iop_v2():
+    """Run the 24-hour IOP model in-process instead of via the CLI script"""
+    try:
+        return jsonify(predict_iop_24h(request.json))
+
+    except Exception as e:
+        app.logger.error("Error: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint"""
@@ -249,6 +318,8 @@ def health_check():
 
 
 if __name__ == '__main__':
+    # The Node server owns port 5000, so Flask defaults to 5001
+    port = int(os.environ.get('FLASK_PORT', 5001))
     print("Starting IOP Forecast API server...")
-    print("Server will be available at: http://localhost:5000")
-    app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+    print(f"Server will be available at: http://localhost:{port}")
+    app.run(debug=False, threaded=True, port=port, host='0.0.0.0')
\ No newline at end of file
@@ -1,98 +1,151 @@
 #!/usr/bin/env python3
 import json
+import os
 import sys
+import threading
+from contextlib import contextmanager, suppress
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import joblib
 import numpy as np
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.preprocessing import StandardScaler
 import warnings
-warnings.filterwarnings('ignore')
 
-def create_circadian_features(hour):
-    """Create circadian rhythm features"""
-    return {
-        'hour_sin': np.sin(2 * np.pi * hour / 24),
-        'hour_cos': np.cos(2 * np.pi * hour / 24),
-        'is_morning': 1 if 6 <= hour <= 11 else 0,
-        'is_evening': 1 if 18 <= hour <= 23 else 0,
-        'is_night': 1 if hour >= 22 or hour <= 5 else 0
-    }
+# Circadian rhythm features for each hour of the day:
+# hour_sin, hour_cos, is_morning, is_evening, is_night
+HOURS = np.arange(24)
+CIRCADIAN_FEATURES = np.column_stack([
+    np.sin(2 * np.pi * HOURS / 24),
+    np.cos(2 * np.pi * HOURS / 24),
+    (HOURS >= 6) & (HOURS <= 11),
+    (HOURS >= 18) & (HOURS <= 23),
+    (HOURS >= 22) | (HOURS <= 5)
+])
 
 def encode_categorical(value, categories):
     """One-hot encode categorical variables"""
     return [1 if value == cat else 0 for cat in categories]
 
-def predict_iop_24h(patient_data):
-    """Predict IOP for 24 hours using Random Forest model"""
-    
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iop_hgb.pkl')
+LOCK_PATH = MODEL_PATH + '.lock'
+
+# Serializes the first load within a process; lru_cache alone does not
+_model_lock = threading.Lock()
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path across processes, if one can be taken"""
+    try:
+        lock_file = open(path, 'w')
+    except OSError:
+        # e.g. a read-only install; fall back to running without a lock
+        yield
+        return
+    with lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def save_atomically(obj, path):
+    """Pickle obj via a per-process temp file so readers never see a partial file"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        joblib.dump(obj, tmp_path, compress=3)
+        os.replace(tmp_path, path)
+    except OSError:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+@lru_cache(maxsize=1)
+def get_model():
+    """Load the cached gradient boosting model, training and saving it on first use"""
+    # Only one thread or process trains; the others wait and load what it saved
+    with _model_lock, file_lock(LOCK_PATH):
+        if os.path.exists(MODEL_PATH):
+            return joblib.load(MODEL_PATH)
+        
+        model = _train_model()
+        
+        # Failing to cache the model should not fail the prediction
+        try:
+            save_atomically(model, MODEL_PATH)
+        except OSError as e:
+            print(f"Could not save model to {MODEL_PATH}: {e}", file=sys.stderr)
+        return model
+
+def _train_model():
+    """Train the gradient boosting model on synthetic IOP data"""
     # Create synthetic training data based on medical literature
     # This simulates a model trained on real glaucoma datasets
     np.random.seed(42)
     
-    # Initialize Random Forest model
-    model = RandomForestRegressor(
-        n_estimators=100,
-        max_depth=10,
-        random_state=42,
-        n_jobs=-1
+    # Initialize histogram-based gradient boosting model
+    model = HistGradientBoostingRegressor(
+        max_iter=100,
+        max_depth=6,
+        learning_rate=0.1,
+        random_state=42
     )
     
-    # Create synthetic training data representing realistic IOP patterns
+    # Create synthetic training data representing realistic IOP patterns.
+    # Patient profiles are arrays of shape (n_samples,) and hourly terms have
+    # shape (24,), so broadcasting yields one (n_samples, 24) IOP grid.
     n_samples = 1000
-    training_data = []
-    training_targets = []
-    
-    for _ in range(n_samples):
-        # Generate synthetic patient profiles
-        age = np.random.normal(60, 15)
-        sleep_quality = np.random.randint(1, 11)
-        stress_level = np.random.randint(1, 11)
-        physical_activity = np.random.randint(1, 11)
-        systolic_bp = np.random.normal(130, 20)
-        diastolic_bp = np.random.normal(80, 10)
-        diabetes_factor = np.random.choice([0, 1, 2])  # none, prediabetes, diabetes
-        family_history_factor = np.random.choice([0, 1, 2])  # none, some, strong
-        hours_since_drop = np.random.uniform(0, 48)
-        
-        # Generate 24-hour IOP patterns
-        for hour in range(24):
-            circadian = create_circadian_features(hour)
-            
-            # Base IOP with circadian rhythm
-            base_iop = 15 + 3 * np.sin((hour - 6) * np.pi / 12)
-            
-            # Risk factors influence
-            age_effect = max(0, (age - 40) * 0.1)
-            sleep_effect = (10 - sleep_quality) * 0.3
-            stress_effect = stress_level * 0.2
-            activity_effect = (10 - physical_activity) * 0.15
-            bp_effect = max(0, (systolic_bp - 120) * 0.05)
-            diabetes_effect = diabetes_factor * 2
-            family_effect = family_history_factor * 1.5
-            
-            # Medication decay effect
-            med_effectiveness = max(0.1, 1 - (hours_since_drop / 24) * 0.7)
-            
-            # Calculate final IOP
-            iop = base_iop + age_effect + sleep_effect + stress_effect + activity_effect + bp_effect + diabetes_effect + family_effect
-            iop = iop / med_effectiveness
-            iop = max(8, min(35, iop + np.random.normal(0, 1)))
-            
-            # Create feature vector
-            features = [
-                age, sleep_quality, stress_level, physical_activity,
-                systolic_bp, diastolic_bp, diabetes_factor, family_history_factor,
-                hours_since_drop, circadian['hour_sin'], circadian['hour_cos'],
-                circadian['is_morning'], circadian['is_evening'], circadian['is_night']
-            ]
-            
-            training_data.append(features)
-            training_targets.append(iop)
+    age = np.random.normal(60, 15, n_samples)
+    sleep_quality = np.random.randint(1, 11, n_samples)
+    stress_level = np.random.randint(1, 11, n_samples)
+    physical_activity = np.random.randint(1, 11, n_samples)
+    systolic_bp = np.random.normal(130, 20, n_samples)
+    diastolic_bp = np.random.normal(80, 10, n_samples)
+    diabetes_factor = np.random.choice([0, 1, 2], n_samples)  # none, prediabetes, diabetes
+    family_history_factor = np.random.choice([0, 1, 2], n_samples)  # none, some, strong
+    hours_since_drop = np.random.uniform(0, 48, n_samples)
+    
+    # Base IOP with circadian rhythm
+    base_iop = 15 + 3 * np.sin((HOURS - 6) * np.pi / 12)
+    
+    # Risk factors influence
+    age_effect = np.maximum(0, (age - 40) * 0.1)
+    sleep_effect = (10 - sleep_quality) * 0.3
+    stress_effect = stress_level * 0.2
+    activity_effect = (10 - physical_activity) * 0.15
+    bp_effect = np.maximum(0, (systolic_bp - 120) * 0.05)
+    diabetes_effect = diabetes_factor * 2
+    family_effect = family_history_factor * 1.5
+    
+    # Medication decay effect
+    med_effectiveness = np.maximum(0.1, 1 - (hours_since_drop / 24) * 0.7)
+    
+    # Calculate final IOP
+    patient_effect = age_effect + sleep_effect + stress_effect + activity_effect + bp_effect + diabetes_effect + family_effect
+    iop = (base_iop[None, :] + patient_effect[:, None]) / med_effectiveness[:, None]
+    iop = np.clip(iop + np.random.normal(0, 1, (n_samples, 24)), 8, 35)
+    
+    # Create feature matrix with one row per (patient, hour), patient-major
+    patient_features = np.column_stack([
+        age, sleep_quality, stress_level, physical_activity,
+        systolic_bp, diastolic_bp, diabetes_factor, family_history_factor,
+        hours_since_drop
+    ])
+    training_data = np.concatenate([
+        np.repeat(patient_features, 24, axis=0),
+        np.tile(CIRCADIAN_FEATURES, (n_samples, 1))
+    ], axis=1)
     
     # Train the model
-    X_train = np.array(training_data)
-    y_train = np.array(training_targets)
+    X_train = training_data
+    y_train = iop.reshape(-1)
     model.fit(X_train, y_train)
+    return model
+
+def predict_iop_24h(patient_data):
+    """Predict IOP for 24 hours using gradient boosting model"""
+    model = get_model()
     
     # Generate predictions for the actual patient
     predictions = []
@@ -115,21 +168,22 @@ def predict_iop_24h(patient_data):
     
     hours_since_drop = patient_data['lastDropHours']
     
-    # Predict for each hour
-    for hour in range(24):
-        circadian = create_circadian_features(hour)
-        
-        # Create feature vector for prediction
-        features = np.array([[
-            age, sleep_quality, stress_level, physical_activity,
-            systolic_bp, diastolic_bp, diabetes_factor, family_history_factor,
-            hours_since_drop, circadian['hour_sin'], circadian['hour_cos'],
-            circadian['is_morning'], circadian['is_evening'], circadian['is_night']
-        ]])
-        
-        predicted_iop = model.predict(features)[0]
-        predicted_iop = max(8, min(35, predicted_iop))
-        
+    # Build all 24 hourly feature rows and predict them in a single batch
+    features = np.empty((24, 14))
+    features[:, 0] = age
+    features[:, 1] = sleep_quality
+    features[:, 2] = stress_level
+    features[:, 3] = physical_activity
+    features[:, 4] = systolic_bp
+    features[:, 5] = diastolic_bp
+    features[:, 6] = diabetes_factor
+    features[:, 7] = family_history_factor
+    features[:, 8] = hours_since_drop + HOURS  # hours since drop grows by one each hour
+    features[:, 9:14] = CIRCADIAN_FEATURES
+    
+    predicted_iops = np.clip(model.predict(features), 8, 35)
+    
+    for hour, predicted_iop in enumerate(predicted_iops.tolist()):
         # Determine risk level
         if predicted_iop < 18:
             risk_level = 'low'
@@ -145,9 +199,6 @@ def predict_iop_24h(patient_data):
             'predicted_iop': round(predicted_iop, 1),
             'risk_level': risk_level
         })
-        
-        # Update hours since drop for next prediction
-        hours_since_drop += 1
     
     # Analysis
     iop_values = [p['predicted_iop'] for p in predictions]
@@ -192,6 +243,7 @@ def predict_iop_24h(patient_data):
     }
 
 def main():
+    warnings.filterwarnings('ignore')
     try:
         # Read input from stdin
         input_data = json.loads(sys.stdin.read())
@@ -128,8 +128,34 @@ function calculateRealTimeRisk(data: any): RealTimeRiskResponse {
   };
 }
 
+// Flask API that keeps the ML model loaded between requests (see app.py)
+const PYTHON_API_URL = process.env.PYTHON_API_URL || 'http://localhost:5001';
+
 // Call Python ML model
 async function callPythonModel(data: any): Promise<IopForecastResponse> {
+  let response: Response;
+  try {
+    response = await fetch(`${PYTHON_API_URL}/api/predict-iop-v2`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(data),
+    });
+  } catch (error) {
+    // Flask API is not running; fall back to running the model script directly
+    console.warn(`Python API unavailable at ${PYTHON_API_URL}, falling back to CLI:`, error instanceof Error ? error.message : error);
+    return spawnPythonModel(data);
+  }
+  
+  const result = await response.json();
+  if (!response.ok) {
+    throw new Error(`Python API failed with status ${response.status}: ${result.error}`);
+  }
+  
+  return result;
+}
+
+// Run the Python ML model as a one-off subprocess
+function spawnPythonModel(data: any): Promise<IopForecastResponse> {
   return new Promise((resolve, reject) => {
     const pythonScript = path.join(process.cwd(), 'server', 'ml', 'iop_model.py');
     const python = spawn('python3', [pythonScript], {